@@ -1,11 +1,71 @@
+import logging
 import os
-from sqlalchemy import create_engine, Column, String, Integer, MetaData, Table, text
+from sqlalchemy import create_engine, event, make_url, Column, String, Integer, Index, MetaData, Table, text
 from sqlalchemy.orm import sessionmaker, declarative_base
+from sqlalchemy.pool import StaticPool
+
+logger = logging.getLogger(__name__)
 
 # Configuration
 DB_URL = os.getenv("DATABASE_URL", "sqlite:///supply_chain.db")
+# Size of the engine's compiled-statement LRU (SQLAlchemy default is 500)
+QUERY_CACHE_SIZE = 1200
+
+_url = make_url(DB_URL)
+# Covers sqlite://, sqlite+pysqlite:///:memory: and URI forms such as file::memory:?cache=shared
+IN_MEMORY_DB = _url.get_backend_name() == "sqlite" and (
+    _url.database in (None, "", ":memory:")
+    or _url.database.startswith("file::memory:")
+    or _url.query.get("mode") == "memory"
+)
+
+if _url.get_backend_name() == "sqlite":
+    if IN_MEMORY_DB:
+        # An in-memory DB only exists on its one connection, so every session shares it.
+        # That makes in-memory mode single-session only: closing or rolling back any
+        # session discards every other session's uncommitted writes. Use it for
+        # throwaway dev/test runs, never behind concurrent requests.
+        engine = create_engine(
+            DB_URL,
+            poolclass=StaticPool,
+            connect_args={"check_same_thread": False},
+            query_cache_size=QUERY_CACHE_SIZE,
+        )
+    else:
+        # File DBs use the default QueuePool: each session checks out its own
+        # connection, so one session's rollback/close cannot discard another's writes.
+        # check_same_thread=False lets a pooled connection be reused by another thread.
+        engine = create_engine(
+            DB_URL,
+            connect_args={"check_same_thread": False},
+            query_cache_size=QUERY_CACHE_SIZE,
+        )
 
-engine = create_engine(DB_URL)
+    @event.listens_for(engine, "connect")
+    def _set_sqlite_pragmas(dbapi_conn, _):
+        # WAL + NORMAL sync: one fsync per checkpoint instead of per commit, and
+        # (file DBs only, one pooled connection per session) readers do not block
+        # on the writer. Temp tables stay in RAM, reads go through a 256MB mmap
+        # and the page cache is 64MB.
+        cur = dbapi_conn.cursor()
+        cur.execute("PRAGMA journal_mode=WAL")
+        cur.execute("PRAGMA synchronous=NORMAL")
+        cur.execute("PRAGMA temp_store=MEMORY")
+        cur.execute("PRAGMA mmap_size=268435456")
+        cur.execute("PRAGMA cache_size=-65536")
+        cur.close()
+else:
+    # LIFO reuse keeps the most recently used (warm) connections in play and lets
+    # idle ones age out; pre_ping drops connections the server has closed.
+    engine = create_engine(
+        DB_URL,
+        pool_size=20,
+        max_overflow=30,
+        pool_use_lifo=True,
+        pool_pre_ping=True,
+        pool_recycle=1800,
+        query_cache_size=QUERY_CACHE_SIZE,
+    )
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 Base = declarative_base()
 
@@ -32,6 +92,8 @@ class ASN(Base):
     status = Column(String)
     eta_datetime = Column(String)
 
+    __table_args__ = (Index("ix_asn_sku_status", "sku", "status"),)
+
 class Order(Base):
     __tablename__ = "orders"
     order_id = Column(String, primary_key=True)
@@ -48,19 +110,55 @@ class ReplenishmentLock(Base):
     asn_id = Column(String)
     qty_locked = Column(Integer)
 
+    __table_args__ = (Index("ix_lock_asn", "asn_id"),)
+
+# sku value for GLOBAL-scope rules, keeping sku non-null in the composite key
+GLOBAL_SKU = "*"
+
 class BusinessRule(Base):
     __tablename__ = "business_rules"
     rule_name = Column(String, primary_key=True)
     scope = Column(String, primary_key=True) # Composite key part
-    sku = Column(String, primary_key=True, nullable=True) # Composite key part, handled carefully
+    sku = Column(String, primary_key=True, nullable=False, default=GLOBAL_SKU, server_default=GLOBAL_SKU) # Composite key part
     # Use synthetic ID or carefully map composite PK
     start_date = Column(String)
     end_date = Column(String)
     value = Column(String)
 
+    # The agent loads rules with one unfiltered SELECT (inventory_mcp._reload_rules),
+    # so this index is not on its hot path; it serves ad-hoc/admin lookups by rule and sku.
+    __table_args__ = (Index("ix_rule_lookup", "rule_name", "sku"),)
+
 
 def init_db():
     Base.metadata.create_all(bind=engine)
+    if engine.dialect.name == "sqlite":
+        # Only SQLite lets a primary-key column hold NULL, so only it can have legacy rows
+        with engine.begin() as conn:
+            _backfill_global_sku(conn)
+
+def _backfill_global_sku(conn):
+    """Moves NULL-sku business rules (pre-GLOBAL_SKU tables) onto the '*' sentinel.
+
+    SQLite allowed several (rule_name, scope, NULL) rows; the first one per
+    (rule_name, scope) is kept and any duplicate is logged and deleted, since
+    it would collide on the primary key once its sku becomes '*'.
+    """
+    rows = conn.execute(text(
+        "SELECT rowid, rule_name, scope, value FROM business_rules WHERE sku IS NULL ORDER BY rowid"
+    )).all()
+    if not rows:
+        return
+    taken = set(conn.execute(
+        text("SELECT rule_name, scope FROM business_rules WHERE sku = :g"), {"g": GLOBAL_SKU}
+    ).all())
+    for rowid, rule_name, scope, value in rows:
+        if (rule_name, scope) in taken:
+            logger.warning("Dropping duplicate business rule %s/%s with NULL sku (value %r)", rule_name, scope, value)
+            conn.execute(text("DELETE FROM business_rules WHERE rowid = :id"), {"id": rowid})
+        else:
+            conn.execute(text("UPDATE business_rules SET sku = :g WHERE rowid = :id"), {"g": GLOBAL_SKU, "id": rowid})
+            taken.add((rule_name, scope))
 
 def get_db():
     db = SessionLocal()
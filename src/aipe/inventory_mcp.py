@@ -1,147 +1,177 @@
-from typing import List, Dict, Optional, Any, Union
+from typing import List, Dict, Optional, Any, Tuple, Union
 import datetime
+import logging
+import time
 from sqlalchemy import text
-from .database import get_db, init_db
+from .database import GLOBAL_SKU, SessionLocal
 
-# Ensure tables exist (mostly for local run)
-init_db()
+logger = logging.getLogger(__name__)
+
+# Tables are not created on import: main.py runs init_db() at FastAPI startup.
+# Any other entry point (scripts, notebooks) must call database.init_db() first.
+
+# Statements are built once at import; SQLAlchemy caches the compiled form
+# per construct, so reusing the same text() objects skips re-parsing.
+_SQL_GET_INV = text("SELECT on_hand_qty, safety_stock_qty FROM inventory WHERE sku = :sku")
+_SQL_GET_ASNS = text("""
+    SELECT a.asn_id, a.qty, a.eta_datetime, COALESCE(SUM(l.qty_locked), 0) AS locked
+    FROM asns a LEFT JOIN replenishment_locks l ON l.asn_id = a.asn_id
+    WHERE a.sku = :sku AND a.status != 'CLOSED'
+    GROUP BY a.asn_id, a.qty, a.eta_datetime
+""")
+_SQL_FIND_ASN = text("""
+    SELECT a.asn_id, a.qty, a.eta_datetime, COALESCE(SUM(l.qty_locked), 0) AS locked
+    FROM asns a LEFT JOIN replenishment_locks l ON l.asn_id = a.asn_id
+    WHERE a.sku = :sku AND a.status != 'CLOSED' AND substr(a.eta_datetime, 1, 10) <= :by_date
+    GROUP BY a.asn_id, a.qty, a.eta_datetime
+    HAVING a.qty - COALESCE(SUM(l.qty_locked), 0) >= :min_qty
+       AND a.qty - COALESCE(SUM(l.qty_locked), 0) > 0
+    ORDER BY a.eta_datetime ASC
+    LIMIT 1
+""")
+_SQL_ALL_RULES = text("SELECT rule_name, scope, sku, start_date, end_date, value FROM business_rules")
+_SQL_UPDATE_INV = text("UPDATE inventory SET on_hand_qty = on_hand_qty - :qty WHERE sku = :sku")
+_SQL_INSERT_LOCK = text("INSERT INTO replenishment_locks (lock_id, sku, asn_id, qty_locked) VALUES (:id, :sku, :asn, :qty)")
+_SQL_UPDATE_ORDER = text("""
+    UPDATE orders 
+    SET status = :status, fulfillment_source = :strat 
+    WHERE order_id = :oid
+""")
 
 def get_inventory_position(sku: str) -> Dict[str, int]:
     """Returns on_hand and safety_stock for a SKU."""
-    # Use generator
-    db_gen = get_db()
-    db = next(db_gen)
-    try:
-        result = db.execute(text("SELECT on_hand_qty, safety_stock_qty FROM inventory WHERE sku = :sku"), {"sku": sku}).fetchone()
-        if result:
-            return {"on_hand": result.on_hand_qty, "safety_stock": result.safety_stock_qty}
-        return {"on_hand": 0, "safety_stock": 0}
-    finally:
-        db.close()
+    with SessionLocal() as db:
+        result = db.execute(_SQL_GET_INV, {"sku": sku}).fetchone()
+    if result:
+        return {"on_hand": result.on_hand_qty, "safety_stock": result.safety_stock_qty}
+    return {"on_hand": 0, "safety_stock": 0}
 
 def get_inbound_asns(sku: str) -> List[Dict[str, Any]]:
     """Returns ASNs minus any qty found in replenishment_locks."""
-    db_gen = get_db()
-    db = next(db_gen)
-    try:
-        # Get all ASNs for SKU
-        rows = db.execute(text("SELECT asn_id, qty, eta_datetime FROM asns WHERE sku = :sku AND status != 'CLOSED'"), {"sku": sku}).fetchall()
-        asns = [dict(row._mapping) for row in rows]
-        
-        # Calculate available qty for each ASN
-        for asn in asns:
-            locked_row = db.execute(text("SELECT SUM(qty_locked) as locked FROM replenishment_locks WHERE asn_id = :asn_id"), {"asn_id": asn["asn_id"]}).fetchone()
-            locked_qty = locked_row.locked if locked_row and locked_row.locked else 0
-            asn["available_qty"] = max(0, asn["qty"] - locked_qty)
-        
-        # Filter out ASNs with no availability
-        return [asn for asn in asns if asn["available_qty"] > 0]
-    finally:
-        db.close()
-
-def get_rule_config(sku: str, rule_name: str) -> Any:
-    today = datetime.date.today().isoformat()
-    db_gen = get_db()
-    db = next(db_gen)
-    try:
-        # 1. Item Scope + Inside Date Range
-        row = db.execute(text("""
-            SELECT value FROM business_rules 
-            WHERE rule_name = :rule_name AND scope = 'ITEM' AND sku = :sku 
-            AND (start_date <= :today OR start_date IS NULL) 
-            AND (end_date >= :today OR end_date IS NULL)
-            AND (start_date IS NOT NULL OR end_date IS NOT NULL)
-        """), {"rule_name": rule_name, "sku": sku, "today": today}).fetchone()
-        
-        if row: 
-            return _parse_value(row.value)
-
-        # 2. Item Scope (No Dates) / 3. Global
-        # Fetch all candidates
-        rows = db.execute(text("""
-            SELECT scope, sku, start_date, end_date, value 
-            FROM business_rules 
-            WHERE rule_name = :rule_name AND (sku = :sku OR scope = 'GLOBAL')
-        """), {"rule_name": rule_name, "sku": sku}).fetchall()
-        
-        rules = [dict(r._mapping) for r in rows]
-        
-    finally:
-        db.close()
-        
-    # Logic (Same as before)
-    # P1
-    for r in rules:
-        if r['scope'] == 'ITEM' and r['sku'] == sku:
-            if r['start_date'] and r['end_date']:
-                 if r['start_date'] <= today <= r['end_date']:
-                     return _parse_value(r['value'])
-            elif r['start_date'] and not r['end_date']:
-                 if r['start_date'] <= today:
-                     return _parse_value(r['value'])
-            elif not r['start_date'] and r['end_date']:
-                 if today <= r['end_date']:
-                     return _parse_value(r['value'])
+    with SessionLocal() as db:
+        # Get all ASNs for SKU with their locked qty in a single round-trip
+        rows = db.execute(_SQL_GET_ASNS, {"sku": sku}).all()
+
+    asns = []
+    for asn_id, qty, eta_datetime, locked_qty in rows:
+        available_qty = qty - locked_qty
+        # Skip ASNs with no availability
+        if available_qty > 0:
+            asns.append(_asn_dict(asn_id, qty, eta_datetime, available_qty))
+    return asns
+
+def _asn_dict(asn_id, qty, eta_datetime, available_qty):
+    # Parse ETA once here so callers compare dates, not strings
+    return {
+        "asn_id": asn_id,
+        "qty": qty,
+        "eta_datetime": eta_datetime,
+        "available_qty": available_qty,
+        "eta_date": datetime.date.fromisoformat(eta_datetime[:10]),
+    }
+
+def find_qualifying_asn(sku: str, min_qty: int, by_date: datetime.date) -> Optional[Dict[str, Any]]:
+    """Returns the earliest open ASN arriving by by_date with at least min_qty unlocked, or None."""
+    with SessionLocal() as db:
+        row = db.execute(_SQL_FIND_ASN, {"sku": sku, "min_qty": min_qty, "by_date": by_date.isoformat()}).fetchone()
+    if row is None:
+        return None
+    asn_id, qty, eta_datetime, locked_qty = row
+    return _asn_dict(asn_id, qty, eta_datetime, qty - locked_qty)
+
+# In-memory view of business_rules, reloaded every _RULES_TTL_SECONDS.
+# Keyed by (rule_name, sku) -> (start_date, end_date, parsed value);
+# GLOBAL rules live under sku GLOBAL_SKU.
+_RULES_TTL_SECONDS = 30.0
+_RULES_CACHE: Dict[Tuple[str, str], Tuple[Optional[str], Optional[str], Any]] = {}
+_RULES_LOADED_AT: float = 0.0
+
+def _reload_rules():
+    global _RULES_CACHE, _RULES_LOADED_AT
+    with SessionLocal() as db:
+        rows = db.execute(_SQL_ALL_RULES).all()
+    rules = {}
+    for rule_name, scope, sku, start_date, end_date, value in rows:
+        if scope == 'ITEM':
+            if sku == GLOBAL_SKU:
+                # An ITEM row saved without a sku picks up the sentinel default;
+                # it names no item, so it must not land on the global key.
+                logger.warning("Skipping business rule %s/ITEM with no sku", rule_name)
+                continue
+            key_sku = sku
+        elif scope == 'GLOBAL':
+            key_sku = GLOBAL_SKU
+        else:
+            # Other scopes (e.g. 'REGION') are not resolved by this lookup
+            continue
+        try:
+            parsed = _parse_value(value)
+        except (TypeError, ValueError):
+            # One bad row must not take down lookups for every other rule
+            logger.warning("Skipping business rule %s/%s/%s: unparseable value %r", rule_name, scope, sku, value)
+            continue
+        rules[(rule_name, key_sku)] = (start_date, end_date, parsed)
+    # Swap in the new dict whole so concurrent readers never see a partial load
+    _RULES_CACHE = rules
+    _RULES_LOADED_AT = time.monotonic()
+
+def invalidate_rule_cache():
+    """Forces the next get_rule_config call in this process to reload business_rules.
+
+    Other worker processes and replicas pick up rule changes when their
+    _RULES_TTL_SECONDS expires.
+    """
+    global _RULES_LOADED_AT
+    _RULES_LOADED_AT = 0.0
+
+def get_rule_config(sku: str, rule_name: str, today: datetime.date) -> Any:
+    """Resolves rule_name for sku as of today (passed in so one agent run reads the clock once)."""
+    if not _RULES_LOADED_AT or time.monotonic() - _RULES_LOADED_AT > _RULES_TTL_SECONDS:
+        _reload_rules()
+    
+    # P1/P2: item rule, honouring its date range if it has one
+    item = _RULES_CACHE.get((rule_name, sku))
+    if item:
+        start_date, end_date, value = item
+        today_iso = today.isoformat()
+        # Empty-string dates count as unset, like NULL
+        if (not start_date or start_date <= today_iso) and (not end_date or end_date >= today_iso):
+            return value
     
-    # P2
-    for r in rules:
-        if r['scope'] == 'ITEM' and r['sku'] == sku:
-            if not r['start_date'] and not r['end_date']:
-                return _parse_value(r['value'])
-
-    # P3
-    for r in rules:
-        if r['scope'] == 'GLOBAL':
-            return _parse_value(r['value'])
-            
-    return None
+    # P3: global rule
+    rule = _RULES_CACHE.get((rule_name, GLOBAL_SKU))
+    return rule[2] if rule else None
+
+_BOOL_MAP = {"true": True, "false": False, "True": True, "False": False, "TRUE": True, "FALSE": False}
 
 def _parse_value(val):
-    if val.lower() == 'true': return True
-    if val.lower() == 'false': return False
+    if val in _BOOL_MAP: return _BOOL_MAP[val]
     try:
         return int(val)
     except ValueError:
-        return val
+        # Rare mixed-case booleans ("tRUE") still parse
+        return _BOOL_MAP.get(val.lower(), val)
 
 def execute_allocation(order_id: str, sku: str, strategy: str, qty: int, asn_id: Optional[str] = None):
     """
     Updates DB based on allocation strategy.
     """
-    db_gen = get_db()
-    db = next(db_gen)
-    try:
-        if strategy == 'SS_BORROW_WITH_REPLENISH':
-            db.execute(text("UPDATE inventory SET on_hand_qty = on_hand_qty - :qty WHERE sku = :sku"), {"qty": qty, "sku": sku})
-            if asn_id:
-                lock_id = f"lock_{order_id}_{asn_id}"
-                db.execute(text("INSERT INTO replenishment_locks (lock_id, sku, asn_id, qty_locked) VALUES (:id, :sku, :asn, :qty)"),
-                               {"id": lock_id, "sku": sku, "asn": asn_id, "qty": qty})
-            status = 'ALLOCATED'
-            
-        elif strategy == 'SS_RISKY':
-            db.execute(text("UPDATE inventory SET on_hand_qty = on_hand_qty - :qty WHERE sku = :sku"), {"qty": qty, "sku": sku})
-            status = 'ALLOCATED'
-            
-        elif strategy == 'DIRECT_INBOUND':
-            status = 'ALLOCATED'
-        
-        else: # FREE_STOCK
-             db.execute(text("UPDATE inventory SET on_hand_qty = on_hand_qty - :qty WHERE sku = :sku"), {"qty": qty, "sku": sku})
-             status = 'ALLOCATED'
-
-        db.execute(text("""
-            UPDATE orders 
-            SET status = :status, fulfillment_source = :strat 
-            WHERE order_id = :oid
-        """), {"status": status, "strat": strategy, "oid": order_id})
-        
-        db.commit()
-    except Exception as e:
-        db.rollback()
-        raise e
-    finally:
-        db.close()
+    status = 'ALLOCATED'
+    params = {"qty": qty, "sku": sku, "status": status, "strat": strategy, "oid": order_id}
+    
+    if strategy == 'SS_BORROW_WITH_REPLENISH' and asn_id:
+        params.update(id=f"lock_{order_id}_{asn_id}", asn=asn_id)
+        writes = (_SQL_UPDATE_INV, _SQL_INSERT_LOCK)
+    elif strategy == 'DIRECT_INBOUND':
+        writes = ()
+    else: # FREE_STOCK, SS_RISKY
+        writes = (_SQL_UPDATE_INV,)
+
+    # One transaction for all writes: commits on exit, rolls back on error
+    with SessionLocal.begin() as db:
+        for stmt in writes:
+            db.execute(stmt, params)
+        db.execute(_SQL_UPDATE_ORDER, params)
     
     return {"status": "success", "strategy": strategy}
 
@@ -1,4 +1,5 @@
 import operator
+import os
 from typing import Annotated, TypedDict, Union, Dict, Any, List
 from langgraph.graph import StateGraph, END
 import datetime
@@ -14,6 +15,10 @@ class AgentState(TypedDict):
     status: str
     strategy: str
     logs: Annotated[List[str], operator.add]
+    # Read from the clock once per run and reused by every node
+    today: datetime.date
+    # Fetched once and carried across nodes to avoid a repeat round-trip
+    inv_pos: Dict[str, int]
 
 def check_free_stock(state: AgentState):
     sku = state['sku']
@@ -24,27 +29,30 @@ def check_free_stock(state: AgentState):
     safety_stock = inv_pos['safety_stock']
     
     available = on_hand - safety_stock
-    state['logs'].append(f"Check Free Stock: OnHand={on_hand}, SS={safety_stock}, Avail={available}")
+    # Collect locally and hand back via the 'logs' reducer; never mutate state['logs']
+    local_logs = [f"Check Free Stock: OnHand={on_hand}, SS={safety_stock}, Avail={available}"]
     
     if available >= order_qty:
         inventory_mcp.execute_allocation(state['order_id'], sku, 'FREE_STOCK', order_qty)
         return {
             "status": "ALLOCATED",
             "strategy": "FREE_STOCK",
-            "logs": [f"Allocated from FREE_STOCK. New Available: {available - order_qty}"]
+            "inv_pos": inv_pos,
+            "logs": local_logs + [f"Allocated from FREE_STOCK. New Available: {available - order_qty}"]
         }
     
     # Pass to next node with context
     return {
         "status": "CHECK_SS", 
-        "logs": ["Insufficient Free Stock. Proceeding to Safety Stock Check."]
+        "inv_pos": inv_pos,
+        "logs": local_logs + ["Insufficient Free Stock. Proceeding to Safety Stock Check."]
     }
 
 def evaluate_safety_stock(state: AgentState):
     sku = state['sku']
     order_qty = state['qty']
     
-    inv_pos = inventory_mcp.get_inventory_position(sku)
+    inv_pos = state.get('inv_pos') or inventory_mcp.get_inventory_position(sku)
     on_hand = inv_pos['on_hand']
     safety_stock = inv_pos['safety_stock']
     
@@ -60,22 +68,13 @@ def evaluate_safety_stock(state: AgentState):
 
     # SS Borrowing Logic
     # Sub-Step A: Qualifying Replenishment
-    window_days = inventory_mcp.get_rule_config(sku, 'REPLENISH_WINDOW_DAYS')
+    window_days = inventory_mcp.get_rule_config(sku, 'REPLENISH_WINDOW_DAYS', state['today'])
     if window_days is None: window_days = 7 # Default
     
-    target_date = datetime.date.today() + datetime.timedelta(days=int(window_days))
-    
-    asns = inventory_mcp.get_inbound_asns(sku)
-    qualifying_asn = None
+    target_date = state['today'] + datetime.timedelta(days=int(window_days))
     
-    for asn in asns:
-        eta = datetime.date.fromisoformat(asn['eta_datetime'].split('T')[0])
-        if eta <= target_date: # Assuming ASN matches quantity needs? Simplified: just need *an* ASN? 
-             # Prompt: "Is there an ASN arriving within...?" 
-             # Usually we need enough qty. Let's assume we need to lock the Borrowed Amount against the ASN.
-             if asn['available_qty'] >= order_qty:
-                 qualifying_asn = asn
-                 break
+    # Usually we need enough qty: the borrowed amount is locked against the ASN.
+    qualifying_asn = inventory_mcp.find_qualifying_asn(sku, order_qty, target_date)
     
     if qualifying_asn:
         inventory_mcp.execute_allocation(state['order_id'], sku, 'SS_BORROW_WITH_REPLENISH', order_qty, asn_id=qualifying_asn['asn_id'])
@@ -86,20 +85,20 @@ def evaluate_safety_stock(state: AgentState):
         }
 
     # Sub-Step B: Risky Depletion
-    allow_risky = inventory_mcp.get_rule_config(sku, 'ALLOW_RISKY_DEPLETION')
-    state['logs'].append(f"No qualifying ASN. Risky Depletion allowed? {allow_risky}")
+    allow_risky = inventory_mcp.get_rule_config(sku, 'ALLOW_RISKY_DEPLETION', state['today'])
+    local_logs = [f"No qualifying ASN. Risky Depletion allowed? {allow_risky}"]
     
     if allow_risky:
         inventory_mcp.execute_allocation(state['order_id'], sku, 'SS_RISKY', order_qty)
         return {
             "status": "ALLOCATED",
             "strategy": "SS_RISKY",
-            "logs": ["SS Risky Borrow Approved."]
+            "logs": local_logs + ["SS Risky Borrow Approved."]
         }
         
     return {
         "status": "CHECK_DIRECT",
-        "logs": ["SS Borrow denied. Proceeding to Direct Inbound."]
+        "logs": local_logs + ["SS Borrow denied. Proceeding to Direct Inbound."]
     }
 
 def direct_inbound_promising(state: AgentState):
@@ -114,16 +113,8 @@ def direct_inbound_promising(state: AgentState):
        # Let's assume we look for the earliest.
        due_date_obj = datetime.date.max
 
-    asns = inventory_mcp.get_inbound_asns(sku)
-    # Sort by ETA
-    asns.sort(key=lambda x: x['eta_datetime'])
-    
-    found_asn = None
-    for asn in asns:
-         eta = datetime.date.fromisoformat(asn['eta_datetime'].split('T')[0])
-         if eta <= due_date_obj and asn['available_qty'] >= order_qty:
-             found_asn = asn
-             break
+    # Earliest ASN by ETA that can cover the order in time
+    found_asn = inventory_mcp.find_qualifying_asn(sku, order_qty, due_date_obj)
              
     if found_asn:
         inventory_mcp.execute_allocation(state['order_id'], sku, 'DIRECT_INBOUND', order_qty, asn_id=found_asn['asn_id'])
@@ -164,7 +155,41 @@ builder.add_edge("direct_inbound_promising", END)
 
 graph = builder.compile()
 
+# Set AIPE_USE_GRAPH=1 to route through LangGraph (e.g. for tracing/debugging)
+USE_GRAPH = os.getenv("AIPE_USE_GRAPH", "0") == "1"
+
+def _merge(state, delta):
+    # Mirrors the graph's channel reducers: logs accumulate, everything else overwrites
+    for key, value in delta.items():
+        if key == 'logs':
+            state['logs'].extend(value)
+        else:
+            state[key] = value
+
+def run_agent_fast(order_id, sku, qty, due_date):
+    """Runs the same node sequence as `graph` without LangGraph's dispatch overhead."""
+    state = {
+        "order_id": order_id,
+        "sku": sku,
+        "qty": qty,
+        "due_date": due_date,
+        "status": "NEW",
+        "strategy": "NONE",
+        "logs": [],
+        "today": datetime.date.today()
+    }
+    
+    _merge(state, check_free_stock(state))
+    if state['status'] != 'ALLOCATED':
+        _merge(state, evaluate_safety_stock(state))
+        if state['status'] != 'ALLOCATED':
+            _merge(state, direct_inbound_promising(state))
+    return state
+
 def run_agent(order_id, sku, qty, due_date):
+    if not USE_GRAPH:
+        return run_agent_fast(order_id, sku, qty, due_date)
+
     initial_state = {
         "order_id": order_id,
         "sku": sku,
@@ -172,7 +197,8 @@ def run_agent(order_id, sku, qty, due_date):
         "due_date": due_date,
         "status": "NEW",
         "strategy": "NONE",
-        "logs": []
+        "logs": [],
+        "today": datetime.date.today()
     }
     
     result = graph.invoke(initial_state)
@@ -1,40 +1,38 @@
 import pytest
-import sqlite3
 import datetime
-from src.aipe.database import reset_db, DB_NAME
-from src.aipe import promising_agent
+from sqlalchemy import text
+from src.aipe.database import reset_db, init_db, SessionLocal, engine, IN_MEMORY_DB
+from src.aipe import promising_agent, inventory_mcp
 
-# Helper to execute SQL for setup
+# Helpers go through the app's engine/pool rather than opening their own sqlite3 connections.
 def run_sql(sql, params=()):
-    # Ensure DB path is correct if DB_NAME is relative
-    # But since we are running from root, DB_NAME="supply_chain.db" works if CWD is root.
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-    cursor.execute(sql, params)
-    conn.commit()
-    conn.close()
+    # exec_driver_sql keeps the DBAPI '?' placeholders used by the fixtures below
+    with SessionLocal() as s:
+        s.connection().exec_driver_sql(sql, params)
+        s.commit()
+
+def bulk_insert(table, rows):
+    """Inserts all rows into table with one executemany in a single transaction."""
+    # Columns missing from a row are inserted as NULL so every row binds the same params
+    cols = list(dict.fromkeys(c for row in rows for c in row))
+    stmt = text(f"INSERT INTO {table} ({', '.join(cols)}) VALUES ({', '.join(':' + c for c in cols)})")
+    with SessionLocal.begin() as s:
+        s.execute(stmt, [{c: row.get(c) for c in cols} for row in rows])
 
 def get_record(table, key_col, key_val):
-    conn = sqlite3.connect(DB_NAME)
-    conn.row_factory = sqlite3.Row
-    cursor = conn.cursor()
-    cursor.execute(f"SELECT * FROM {table} WHERE {key_col} = ?", (key_val,))
-    row = cursor.fetchone()
-    conn.close()
-    return dict(row) if row else None
+    with SessionLocal() as s:
+        row = s.execute(text(f"SELECT * FROM {table} WHERE {key_col} = :key"), {"key": key_val}).fetchone()
+    return dict(row._mapping) if row else None
 
 def get_locks():
-    conn = sqlite3.connect(DB_NAME)
-    conn.row_factory = sqlite3.Row
-    cursor = conn.cursor()
-    cursor.execute("SELECT * FROM replenishment_locks")
-    rows = cursor.fetchall()
-    conn.close()
-    return [dict(r) for r in rows]
+    with SessionLocal() as s:
+        rows = s.execute(text("SELECT * FROM replenishment_locks")).fetchall()
+    return [dict(r._mapping) for r in rows]
 
 @pytest.fixture(autouse=True)
 def setup_teardown():
     reset_db()
+    inventory_mcp.invalidate_rule_cache()
     yield
     # No teardown needed, reset happens at start
 
@@ -48,18 +46,15 @@ def test_happy_path_ss_borrow_repay():
     """
     sku = 'A'
     # Inventory
-    run_sql("INSERT INTO inventory (sku, on_hand_qty, safety_stock_qty) VALUES (?, ?, ?)", (sku, 10, 10))
+    bulk_insert("inventory", [{"sku": sku, "on_hand_qty": 10, "safety_stock_qty": 10}])
     # ASN
     eta = (datetime.date.today() + datetime.timedelta(days=2)).isoformat()
-    run_sql("INSERT INTO asns (asn_id, sku, qty, status, eta_datetime) VALUES (?, ?, ?, ?, ?)", 
-            ('ASN_A', sku, 50, 'IN_TRANSIT', eta))
+    bulk_insert("asns", [{"asn_id": 'ASN_A', "sku": sku, "qty": 50, "status": 'IN_TRANSIT', "eta_datetime": eta}])
     # Config
-    run_sql("INSERT INTO business_rules (rule_name, scope, value) VALUES (?, ?, ?)", 
-            ('REPLENISH_WINDOW_DAYS', 'GLOBAL', '5'))
+    bulk_insert("business_rules", [{"rule_name": 'REPLENISH_WINDOW_DAYS', "scope": 'GLOBAL', "sku": '*', "value": '5'}])
     # Order
     order_id = 'ORD_A'
-    run_sql("INSERT INTO orders (order_id, sku, qty, due_date, status) VALUES (?, ?, ?, ?, ?)", 
-            (order_id, sku, 5, '2025-12-31', 'NEW')) # Due date doesn't matter for SS borrow logic
+    bulk_insert("orders", [{"order_id": order_id, "sku": sku, "qty": 5, "due_date": '2025-12-31', "status": 'NEW'}]) # Due date doesn't matter for SS borrow logic
 
     # Run Agent
     result = promising_agent.run_agent(order_id, sku, 5, '2025-12-31')
@@ -91,20 +86,20 @@ def test_too_far_rejection():
     Let's set Due Date < 20 days to fail Direct Inbound too for this specific test goal ("Order Status != ALLOCATED").
     """
     sku = 'B'
-    run_sql("INSERT INTO inventory (sku, on_hand_qty, safety_stock_qty) VALUES (?, ?, ?)", (sku, 10, 10))
+    bulk_insert("inventory", [{"sku": sku, "on_hand_qty": 10, "safety_stock_qty": 10}])
     
     eta = (datetime.date.today() + datetime.timedelta(days=20)).isoformat()
-    run_sql("INSERT INTO asns (asn_id, sku, qty, status, eta_datetime) VALUES (?, ?, ?, ?, ?)", 
-            ('ASN_B', sku, 50, 'IN_TRANSIT', eta))
+    bulk_insert("asns", [{"asn_id": 'ASN_B', "sku": sku, "qty": 50, "status": 'IN_TRANSIT', "eta_datetime": eta}])
     
-    run_sql("INSERT INTO business_rules (rule_name, scope, value) VALUES (?, ?, ?)", ('REPLENISH_WINDOW_DAYS', 'GLOBAL', '5'))
-    run_sql("INSERT INTO business_rules (rule_name, scope, value) VALUES (?, ?, ?)", ('ALLOW_RISKY_DEPLETION', 'GLOBAL', 'False'))
+    bulk_insert("business_rules", [
+        {"rule_name": 'REPLENISH_WINDOW_DAYS', "scope": 'GLOBAL', "sku": '*', "value": '5'},
+        {"rule_name": 'ALLOW_RISKY_DEPLETION', "scope": 'GLOBAL', "sku": '*', "value": 'False'},
+    ])
     
     order_id = 'ORD_B'
     # Due date in 10 days (before ASN arrives) -> Should fail Direct Inbound too
     due_date = (datetime.date.today() + datetime.timedelta(days=10)).isoformat()
-    run_sql("INSERT INTO orders (order_id, sku, qty, due_date, status) VALUES (?, ?, ?, ?, ?)", 
-            (order_id, sku, 5, due_date, 'NEW'))
+    bulk_insert("orders", [{"order_id": order_id, "sku": sku, "qty": 5, "due_date": due_date, "status": 'NEW'}])
 
     result = promising_agent.run_agent(order_id, sku, 5, due_date)
     
@@ -128,15 +123,17 @@ def test_risky_override():
     Expect: ALLOCATED, SS_RISKY.
     """
     sku = 'C'
-    run_sql("INSERT INTO inventory (sku, on_hand_qty, safety_stock_qty) VALUES (?, ?, ?)", (sku, 10, 10))
+    bulk_insert("inventory", [{"sku": sku, "on_hand_qty": 10, "safety_stock_qty": 10}])
     eta = (datetime.date.today() + datetime.timedelta(days=20)).isoformat()
-    run_sql("INSERT INTO asns (asn_id, sku, qty, status, eta_datetime) VALUES (?, ?, ?, ?, ?)", ('ASN_C', sku, 50, 'IN_TRANSIT', eta))
+    bulk_insert("asns", [{"asn_id": 'ASN_C', "sku": sku, "qty": 50, "status": 'IN_TRANSIT', "eta_datetime": eta}])
     
-    run_sql("INSERT INTO business_rules (rule_name, scope, value) VALUES (?, ?, ?)", ('REPLENISH_WINDOW_DAYS', 'GLOBAL', '5'))
-    run_sql("INSERT INTO business_rules (rule_name, scope, value) VALUES (?, ?, ?)", ('ALLOW_RISKY_DEPLETION', 'GLOBAL', 'True'))
+    bulk_insert("business_rules", [
+        {"rule_name": 'REPLENISH_WINDOW_DAYS', "scope": 'GLOBAL', "sku": '*', "value": '5'},
+        {"rule_name": 'ALLOW_RISKY_DEPLETION', "scope": 'GLOBAL', "sku": '*', "value": 'True'},
+    ])
     
     order_id = 'ORD_C'
-    run_sql("INSERT INTO orders (order_id, sku, qty, due_date, status) VALUES (?, ?, ?, ?, ?)", (order_id, sku, 5, '2025-12-31', 'NEW'))
+    bulk_insert("orders", [{"order_id": order_id, "sku": sku, "qty": 5, "due_date": '2025-12-31', "status": 'NEW'}])
 
     result = promising_agent.run_agent(order_id, sku, 5, '2025-12-31')
     
@@ -157,19 +154,219 @@ def test_hierarchy_check():
     Expect: ALLOCATED (Item override).
     """
     sku = 'D'
-    run_sql("INSERT INTO inventory (sku, on_hand_qty, safety_stock_qty) VALUES (?, ?, ?)", (sku, 10, 10))
+    bulk_insert("inventory", [{"sku": sku, "on_hand_qty": 10, "safety_stock_qty": 10}])
     eta = (datetime.date.today() + datetime.timedelta(days=20)).isoformat()
-    run_sql("INSERT INTO asns (asn_id, sku, qty, status, eta_datetime) VALUES (?, ?, ?, ?, ?)", ('ASN_D', sku, 50, 'IN_TRANSIT', eta))
+    bulk_insert("asns", [{"asn_id": 'ASN_D', "sku": sku, "qty": 50, "status": 'IN_TRANSIT', "eta_datetime": eta}])
     
-    run_sql("INSERT INTO business_rules (rule_name, scope, value) VALUES (?, ?, ?)", ('REPLENISH_WINDOW_DAYS', 'GLOBAL', '5'))
-    run_sql("INSERT INTO business_rules (rule_name, scope, value) VALUES (?, ?, ?)", ('ALLOW_RISKY_DEPLETION', 'GLOBAL', 'False'))
-    run_sql("INSERT INTO business_rules (rule_name, scope, sku, value) VALUES (?, ?, ?, ?)", ('ALLOW_RISKY_DEPLETION', 'ITEM', sku, 'True'))
+    bulk_insert("business_rules", [
+        {"rule_name": 'REPLENISH_WINDOW_DAYS', "scope": 'GLOBAL', "sku": '*', "value": '5'},
+        {"rule_name": 'ALLOW_RISKY_DEPLETION', "scope": 'GLOBAL', "sku": '*', "value": 'False'},
+        {"rule_name": 'ALLOW_RISKY_DEPLETION', "scope": 'ITEM', "sku": sku, "value": 'True'},
+    ])
     
     order_id = 'ORD_D'
-    run_sql("INSERT INTO orders (order_id, sku, qty, due_date, status) VALUES (?, ?, ?, ?, ?)", (order_id, sku, 5, '2025-12-31', 'NEW'))
+    bulk_insert("orders", [{"order_id": order_id, "sku": sku, "qty": 5, "due_date": '2025-12-31', "status": 'NEW'}])
 
     result = promising_agent.run_agent(order_id, sku, 5, '2025-12-31')
     
     assert result['status'] == 'ALLOCATED'
     # Should stay SS_RISKY because replenishment lookup failed (too far) but risky allowed
     assert result['strategy'] == 'SS_RISKY'
+
+
+def test_rule_cache_invalidation():
+    """
+    Rule lookups are cached; a rule write is only visible after invalidation.
+    """
+    sku = 'E'
+    today = datetime.date.today()
+    bulk_insert("business_rules", [{"rule_name": 'REPLENISH_WINDOW_DAYS', "scope": 'GLOBAL', "sku": '*', "value": '5'}])
+    assert inventory_mcp.get_rule_config(sku, 'REPLENISH_WINDOW_DAYS', today) == 5
+
+    run_sql("UPDATE business_rules SET value = ? WHERE rule_name = ?", ('9', 'REPLENISH_WINDOW_DAYS'))
+    assert inventory_mcp.get_rule_config(sku, 'REPLENISH_WINDOW_DAYS', today) == 5
+
+    inventory_mcp.invalidate_rule_cache()
+    assert inventory_mcp.get_rule_config(sku, 'REPLENISH_WINDOW_DAYS', today) == 9
+
+def test_rule_priority_date_scoped_item():
+    """
+    Rule priority: an ITEM rule overrides GLOBAL only while inside its date range.
+    """
+    sku = 'F'
+    today = datetime.date.today()
+    past = (today - datetime.timedelta(days=10)).isoformat()
+    yesterday = (today - datetime.timedelta(days=1)).isoformat()
+    future = (today + datetime.timedelta(days=10)).isoformat()
+    bulk_insert("business_rules", [
+        {"rule_name": 'REPLENISH_WINDOW_DAYS', "scope": 'GLOBAL', "sku": '*', "value": '5'},
+        {"rule_name": 'REPLENISH_WINDOW_DAYS', "scope": 'ITEM', "sku": sku, "start_date": past, "end_date": future, "value": '3'},
+    ])
+    assert inventory_mcp.get_rule_config(sku, 'REPLENISH_WINDOW_DAYS', today) == 3
+    assert inventory_mcp.get_rule_config('OTHER', 'REPLENISH_WINDOW_DAYS', today) == 5
+
+    # Expired item rule falls back to global
+    run_sql("UPDATE business_rules SET end_date = ? WHERE scope = 'ITEM'", (yesterday,))
+    inventory_mcp.invalidate_rule_cache()
+    assert inventory_mcp.get_rule_config(sku, 'REPLENISH_WINDOW_DAYS', today) == 5
+
+def test_direct_inbound_skips_locked_asn():
+    """
+    Test Case: Direct Inbound
+    SKU 'G', On Hand 0. ASN_G1 in 3 days (50, 45 already locked), ASN_G2 in 5 days (+50).
+    Order 10 units due in 10 days.
+    Expect: ALLOCATED, DIRECT_INBOUND against the earliest ASN with enough unlocked qty (ASN_G2).
+    """
+    sku = 'G'
+    bulk_insert("inventory", [{"sku": sku, "on_hand_qty": 0, "safety_stock_qty": 10}])
+    eta1 = (datetime.date.today() + datetime.timedelta(days=3)).isoformat()
+    eta2 = (datetime.date.today() + datetime.timedelta(days=5)).isoformat()
+    bulk_insert("asns", [
+        {"asn_id": 'ASN_G1', "sku": sku, "qty": 50, "status": 'IN_TRANSIT', "eta_datetime": eta1},
+        {"asn_id": 'ASN_G2', "sku": sku, "qty": 50, "status": 'IN_TRANSIT', "eta_datetime": eta2},
+    ])
+    bulk_insert("replenishment_locks", [{"lock_id": 'lock_prev', "sku": sku, "asn_id": 'ASN_G1', "qty_locked": 45}])
+
+    order_id = 'ORD_G'
+    due_date = (datetime.date.today() + datetime.timedelta(days=10)).isoformat()
+    bulk_insert("orders", [{"order_id": order_id, "sku": sku, "qty": 10, "due_date": due_date, "status": 'NEW'}])
+
+    result = promising_agent.run_agent(order_id, sku, 10, due_date)
+
+    assert result['status'] == 'ALLOCATED'
+    assert result['strategy'] == 'DIRECT_INBOUND'
+    assert 'ASN_G2' in result['logs'][-1]
+    order = get_record('orders', 'order_id', order_id)
+    assert order['fulfillment_source'] == 'DIRECT_INBOUND'
+
+def test_fast_path_matches_graph():
+    """
+    run_agent_fast must produce the same final state as the LangGraph graph.
+    Uses a backorder scenario so neither run writes to the DB.
+    """
+    sku = 'H'
+    bulk_insert("inventory", [{"sku": sku, "on_hand_qty": 10, "safety_stock_qty": 10}])
+    due_date = (datetime.date.today() + datetime.timedelta(days=10)).isoformat()
+
+    fast = promising_agent.run_agent_fast('ORD_H', sku, 5, due_date)
+    slow = promising_agent.graph.invoke({
+        "order_id": 'ORD_H', "sku": sku, "qty": 5, "due_date": due_date,
+        "status": "NEW", "strategy": "NONE", "logs": [], "today": datetime.date.today()
+    })
+
+    assert fast['status'] == slow['status'] == 'BACKORDER'
+    assert fast['strategy'] == slow['strategy']
+    assert fast['logs'] == slow['logs']
+
+
+@pytest.mark.skipif(IN_MEMORY_DB, reason="in-memory SQLite shares one connection and is single-session only")
+def test_concurrent_session_does_not_discard_writes():
+    """
+    A session opened and closed while another has uncommitted writes must not
+    roll those writes back (they would be lost if both shared one connection).
+    """
+    sku = 'I'
+    bulk_insert("inventory", [{"sku": sku, "on_hand_qty": 10, "safety_stock_qty": 0}])
+
+    with SessionLocal.begin() as writer:
+        writer.execute(text("UPDATE inventory SET on_hand_qty = on_hand_qty - 5 WHERE sku = :sku"), {"sku": sku})
+        with SessionLocal() as reader:
+            reader.execute(text("SELECT 1")).fetchone()
+
+    assert get_record('inventory', 'sku', sku)['on_hand_qty'] == 5
+
+
+@pytest.mark.parametrize("raw, expected", [
+    ('True', True), ('false', False), ('tRUE', True),
+    ('5', 5), ('-3', -3), ('+5', 5), (' 5', 5), ('1_000', 1000), (' 0', 0),
+    ('--5', '--5'), ('abc', 'abc'),
+])
+def test_parse_value(raw, expected):
+    assert inventory_mcp._parse_value(raw) == expected
+
+
+def test_bad_rule_value_is_isolated():
+    """
+    A rule row with an unparseable value is skipped; other rules still resolve.
+    """
+    today = datetime.date.today()
+    bulk_insert("business_rules", [
+        {"rule_name": 'REPLENISH_WINDOW_DAYS', "scope": 'GLOBAL', "sku": '*', "value": '5'},
+        {"rule_name": 'ALLOW_RISKY_DEPLETION', "scope": 'ITEM', "sku": 'Z', "value": None},
+    ])
+    assert inventory_mcp.get_rule_config('A', 'REPLENISH_WINDOW_DAYS', today) == 5
+    assert inventory_mcp.get_rule_config('Z', 'ALLOW_RISKY_DEPLETION', today) is None
+
+
+def test_unknown_rule_scope_is_ignored():
+    """
+    Only GLOBAL-scope rows act as the global fallback; other scopes are ignored.
+    """
+    today = datetime.date.today()
+    bulk_insert("business_rules", [
+        {"rule_name": 'ALLOW_RISKY_DEPLETION', "scope": 'GLOBAL', "sku": '*', "value": 'False'},
+        {"rule_name": 'ALLOW_RISKY_DEPLETION', "scope": 'REGION', "sku": '*', "value": 'True'},
+    ])
+    assert inventory_mcp.get_rule_config('A', 'ALLOW_RISKY_DEPLETION', today) is False
+
+
+def test_item_rule_without_sku_is_ignored():
+    """
+    An ITEM rule inserted without a sku gets the '*' default but must not act as global.
+    """
+    today = datetime.date.today()
+    run_sql("INSERT INTO business_rules (rule_name, scope, value) VALUES (?, ?, ?)", ('ALLOW_RISKY_DEPLETION', 'ITEM', 'True'))
+    assert inventory_mcp.get_rule_config('A', 'ALLOW_RISKY_DEPLETION', today) is None
+
+    bulk_insert("business_rules", [{"rule_name": 'ALLOW_RISKY_DEPLETION', "scope": 'GLOBAL', "sku": '*', "value": 'False'}])
+    inventory_mcp.invalidate_rule_cache()
+    assert inventory_mcp.get_rule_config('A', 'ALLOW_RISKY_DEPLETION', today) is False
+
+
+@pytest.mark.skipif(engine.dialect.name != "sqlite", reason="legacy NULL-sku rows and their backfill are SQLite-only")
+def test_init_db_backfills_legacy_null_sku_rules():
+    """
+    Pre-sentinel tables could hold several NULL-sku GLOBAL rows for one rule.
+    init_db() keeps the first per (rule_name, scope) on sku '*' and drops the rest.
+    """
+    # Recreate business_rules with the old nullable-sku primary key
+    run_sql("DROP TABLE business_rules")
+    run_sql("""CREATE TABLE business_rules (
+        rule_name VARCHAR NOT NULL, scope VARCHAR NOT NULL, sku VARCHAR,
+        start_date VARCHAR, end_date VARCHAR, value VARCHAR,
+        PRIMARY KEY (rule_name, scope, sku))""")
+    run_sql("INSERT INTO business_rules (rule_name, scope, value) VALUES (?, ?, ?)", ('REPLENISH_WINDOW_DAYS', 'GLOBAL', '5'))
+    run_sql("INSERT INTO business_rules (rule_name, scope, value) VALUES (?, ?, ?)", ('REPLENISH_WINDOW_DAYS', 'GLOBAL', '9'))
+    run_sql("INSERT INTO business_rules (rule_name, scope, value) VALUES (?, ?, ?)", ('ALLOW_RISKY_DEPLETION', 'GLOBAL', 'True'))
+
+    init_db()
+
+    with SessionLocal() as s:
+        rows = s.execute(text("SELECT rule_name, sku, value FROM business_rules ORDER BY rule_name")).all()
+    assert [tuple(r) for r in rows] == [('ALLOW_RISKY_DEPLETION', '*', 'True'), ('REPLENISH_WINDOW_DAYS', '*', '5')]
+    assert inventory_mcp.get_rule_config('A', 'REPLENISH_WINDOW_DAYS', datetime.date.today()) == 5
+
+
+def test_find_qualifying_asn_skips_fully_locked():
+    """
+    A fully locked ASN never qualifies, even for a zero-qty request.
+    """
+    sku = 'K'
+    eta = (datetime.date.today() + datetime.timedelta(days=2)).isoformat()
+    bulk_insert("asns", [{"asn_id": 'ASN_K', "sku": sku, "qty": 10, "status": 'IN_TRANSIT', "eta_datetime": eta}])
+    bulk_insert("replenishment_locks", [{"lock_id": 'lock_k', "sku": sku, "asn_id": 'ASN_K', "qty_locked": 10}])
+
+    by_date = datetime.date.today() + datetime.timedelta(days=5)
+    assert inventory_mcp.find_qualifying_asn(sku, 0, by_date) is None
+
+
+def test_item_rule_with_empty_dates_is_undated():
+    """
+    Empty-string start/end dates on an ITEM rule mean "no date range", not expired.
+    """
+    sku = 'L'
+    bulk_insert("business_rules", [
+        {"rule_name": 'REPLENISH_WINDOW_DAYS', "scope": 'GLOBAL', "sku": '*', "value": '9'},
+        {"rule_name": 'REPLENISH_WINDOW_DAYS', "scope": 'ITEM', "sku": sku, "start_date": '', "end_date": '', "value": '3'},
+    ])
+    assert inventory_mcp.get_rule_config(sku, 'REPLENISH_WINDOW_DAYS', datetime.date.today()) == 3